@@ -1,16 +1,21 @@
 # reexport beam search here
 from universal_ml_utils.decoding.beam import beam_search
 from universal_ml_utils.decoding.utils import (
+    BatchScoreFn,
+    BatchStopFn,
+    BatchUpdateFn,
     Beam,
     CacheFn,
     DecodeFn,
     LogitFn,
+    PrefixCacheFn,
     SampleFn,
     ScoreFn,
     StopFn,
     UpdateFn,
     allow_tokens,
     constrain,
+    eos_stop,
     greedy,
     identity_update,
     log_likelihood_score,
@@ -25,13 +30,18 @@ from universal_ml_utils.decoding.utils import (
 __all__ = [
     "beam_search",
     "Beam",
+    "BatchScoreFn",
+    "BatchStopFn",
+    "BatchUpdateFn",
     "CacheFn",
     "DecodeFn",
     "LogitFn",
+    "PrefixCacheFn",
     "SampleFn",
     "ScoreFn",
     "StopFn",
     "UpdateFn",
+    "eos_stop",
     "greedy",
     "identity_update",
     "log_likelihood_score",
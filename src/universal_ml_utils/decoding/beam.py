@@ -1,17 +1,24 @@
-from typing import Generator
+import itertools
+import math
+from dataclasses import dataclass
+from typing import Generator, Iterator
 
 try:
+    import numpy as np
     import torch
-    from torch.nn.utils.rnn import pad_sequence
 except ImportError:
-    raise ImportError("torch needs to be installed to use the decoding module.")
+    raise ImportError(
+        "numpy and torch need to be installed to use the decoding module."
+    )
 
 
+from universal_ml_utils.decoding.kernels import rank_candidates
 from universal_ml_utils.decoding.utils import (
     Beam,
     CacheFn,
     DecodeFn,
     LogitFn,
+    PrefixCacheFn,
     SampleFn,
     ScoreFn,
     StopFn,
@@ -22,6 +29,230 @@ from universal_ml_utils.decoding.utils import (
 )
 
 
+@dataclass
+class BeamBatch:
+    # beams grouped by batch element together with their
+    # numeric state as arrays, for vectorized bookkeeping
+    beams: list[Beam]
+    indices: np.ndarray
+    lengths: np.ndarray
+    initial_lengths: np.ndarray
+    decoded_log_probs: np.ndarray
+
+    @staticmethod
+    def from_beams(beams: list[Beam], indices: list[int] | None = None) -> "BeamBatch":
+        n = len(beams)
+        if indices is None:
+            # batch element indices are not needed, e.g. for scoring
+            indices = [0] * n
+
+        return BeamBatch(
+            beams,
+            np.asarray(indices, dtype=np.int64),
+            np.fromiter((len(b) for b in beams), dtype=np.int64, count=n),
+            np.fromiter((b.initial_length for b in beams), dtype=np.int64, count=n),
+            np.fromiter((b.decoded_log_prob for b in beams), dtype=np.float64, count=n),
+        )
+
+    @property
+    def decoded_lengths(self) -> np.ndarray:
+        return self.lengths - self.initial_lengths
+
+    def select(self, mask: np.ndarray) -> "BeamBatch":
+        return BeamBatch(
+            [self.beams[i] for i in np.flatnonzero(mask)],
+            self.indices[mask],
+            self.lengths[mask],
+            self.initial_lengths[mask],
+            self.decoded_log_probs[mask],
+        )
+
+    def __len__(self) -> int:
+        return len(self.beams)
+
+
+class Candidates:
+    # candidates of a decoding step, the flat index of a candidate is
+    # beam index * num selected + selection index; candidates are only
+    # created when needed, either for scoring with a non-vectorized
+    # score function or when they are selected
+    def __init__(
+        self,
+        beams: list[Beam],
+        selected_ids: np.ndarray,
+        selected_log_probs: np.ndarray,
+    ) -> None:
+        self.beams = beams
+        self.selected_ids = selected_ids
+        self.selected_log_probs = selected_log_probs
+        self.num_selected = selected_ids.shape[1]
+        # invalid selections are marked with -1
+        self.valid = selected_ids.ravel() >= 0
+        self._candidates: dict[int, Beam] = {}
+
+    def __getitem__(self, c: int) -> Beam:
+        candidate = self._candidates.get(c)
+        if candidate is not None:
+            return candidate
+
+        i, j = divmod(c, self.num_selected)
+        candidate = self.beams[i].clone()
+        candidate.add(
+            int(self.selected_ids[i, j]),
+            float(self.selected_log_probs[i, j]),
+        )
+        self._candidates[c] = candidate
+        return candidate
+
+
+class RankedCandidates:
+    # valid candidates of every batch element by descending score,
+    # only the best k candidates are ranked upfront, the remaining ones
+    # only if the update function rejects too many of them
+    def __init__(
+        self,
+        candidates: Candidates,
+        scores: np.ndarray,
+        batch_indices: np.ndarray,
+        batch_size: int,
+        k: int,
+        compiled: bool = False,
+    ) -> None:
+        self.candidates = candidates
+        self.scores = scores
+        self.batch_indices = batch_indices
+        self.batch_size = batch_size
+        self.k = k
+        self.compiled = compiled
+        self.order, self.bounds = rank_candidates(
+            scores,
+            candidates.valid,
+            batch_indices,
+            batch_size,
+            k,
+            compiled,
+        )
+        self._remaining: tuple[np.ndarray, np.ndarray] | None = None
+
+    def _rank_remaining(self) -> tuple[np.ndarray, np.ndarray]:
+        if self._remaining is None:
+            # all remaining candidates are worse than the ranked ones
+            ranked = np.zeros(len(self.scores), dtype=bool)
+            ranked[self.order] = True
+            self._remaining = rank_candidates(
+                self.scores,
+                self.candidates.valid & ~ranked,
+                self.batch_indices,
+                self.batch_size,
+                compiled=self.compiled,
+            )
+
+        return self._remaining
+
+    def batch_element(self, batch_idx: int) -> Iterator[Beam]:
+        start, end = self.bounds[batch_idx], self.bounds[batch_idx + 1]
+        for c in self.order[start:end]:
+            yield self.candidates[int(c)]
+
+        if end - start < self.k:
+            # all valid candidates of the batch element were ranked
+            return
+
+        order, bounds = self._rank_remaining()
+        for c in order[bounds[batch_idx] : bounds[batch_idx + 1]]:
+            yield self.candidates[int(c)]
+
+    def select(self, update_fn: UpdateFn) -> list[list[Beam]]:
+        # select the k best candidates of every batch element
+        # that are accepted by the update function
+        selected: list[list[Beam]] = [[] for _ in range(self.batch_size)]
+        batch_update_fn = getattr(update_fn, "batch", None)
+        if batch_update_fn is None:
+            for batch_idx in range(self.batch_size):
+                for candidate in self.batch_element(batch_idx):
+                    # update candidates
+                    candidate = update_fn(candidate)
+                    if candidate is None:
+                        # skip invalid candidates
+                        continue
+
+                    selected[batch_idx].append(candidate)
+                    if len(selected[batch_idx]) >= self.k:
+                        break
+
+            return selected
+
+        # update the best remaining candidates of all batch elements
+        # with a single call, as many as are missing per batch element,
+        # and repeat for batch elements with rejected candidates;
+        # this selects the same candidates as updating them one by one
+        ranked = [self.batch_element(b) for b in range(self.batch_size)]
+        while True:
+            chunk = []
+            chunk_indices = []
+            for batch_idx in range(self.batch_size):
+                missing = self.k - len(selected[batch_idx])
+                if missing <= 0:
+                    continue
+
+                best = list(itertools.islice(ranked[batch_idx], missing))
+                chunk.extend(best)
+                chunk_indices.extend([batch_idx] * len(best))
+
+            if not chunk:
+                return selected
+
+            for batch_idx, candidate in zip(
+                chunk_indices, batch_update_fn(chunk), strict=True
+            ):
+                if candidate is None:
+                    # skip invalid candidates
+                    continue
+
+                selected[batch_idx].append(candidate)
+
+
+def select_single(
+    beams: list[Beam],
+    indices: np.ndarray,
+    selected_ids: np.ndarray,
+    selected_log_probs: np.ndarray,
+    batch_size: int,
+    update_fn: UpdateFn,
+) -> list[list[Beam]]:
+    # with a beam width of one every batch element has at most one beam
+    # with a single candidate, so there is nothing to score or rank and
+    # the beams can be extended in place
+    selected: list[list[Beam]] = [[] for _ in range(batch_size)]
+    candidates = []
+    candidate_indices = []
+    for beam, batch_idx, token_id, log_p in zip(
+        beams,
+        indices.tolist(),
+        selected_ids[:, 0].tolist(),
+        selected_log_probs[:, 0].tolist(),
+    ):
+        if token_id < 0:
+            # skip invalid candidates
+            continue
+
+        beam.add(token_id, log_p)
+        candidates.append(beam)
+        candidate_indices.append(batch_idx)
+
+    batch_update_fn = getattr(update_fn, "batch", None)
+    if batch_update_fn is not None:
+        updated = batch_update_fn(candidates)
+    else:
+        updated = [update_fn(candidate) for candidate in candidates]
+
+    for batch_idx, candidate in zip(candidate_indices, updated, strict=True):
+        if candidate is not None:
+            selected[batch_idx].append(candidate)
+
+    return selected
+
+
 @torch.inference_mode()
 def beam_search(
     decode_fn: DecodeFn,
@@ -36,10 +267,14 @@ def beam_search(
     score_fn: ScoreFn = log_likelihood_score(),
     logit_fns: list[LogitFn] | None = None,
     cache_fn: CacheFn | None = None,
+    prefix_cache_fn: PrefixCacheFn | None = None,
     stop_condition: str = "estimated_score",
     max_new_tokens: int | None = None,
     yield_intermediate: bool = False,
     return_unfinished: bool = False,
+    free_cache: bool = False,
+    compile_selection: bool = False,
+    compile_ranking: bool = False,
 ) -> Generator[list[list[Beam]], None, list[list[Beam]]]:
     assert max_new_tokens is None or max_new_tokens > 0, (
         "max_new_tokens must be None or positive"
@@ -50,6 +285,16 @@ def beam_search(
         "max_outputs",
     }, "stop condition must be 'max_score', 'estimated_score' or 'max_outputs'"
     assert beam_width >= 1, "beam width must be greater than or equal to 1"
+    assert cache_fn is None or prefix_cache_fn is None, (
+        "only one of cache_fn and prefix_cache_fn can be provided"
+    )
+    # only the fused selection of the sample function is compiled
+    assert not compile_selection or (
+        hasattr(sample_fn, "log_softmax_topk") and not logit_fns
+    ), (
+        "compile_selection requires a sample_fn with a fused log_softmax_topk "
+        "(e.g. greedy()) and no logit_fns"
+    )
     batch_size = len(initial)
 
     current_beams: list[list[Beam]] = []
@@ -68,69 +313,109 @@ def beam_search(
         finished_beams.append([])
         too_long_beams.append([])
 
-    def too_long(beam: Beam) -> bool:
-        if len(beam) >= max_length:
-            return True
-        elif max_new_tokens is None:
-            return False
-        else:
-            return beam.decoded_length >= max_new_tokens
+    def score(batch: BeamBatch, lengths: np.ndarray | None = None) -> np.ndarray:
+        batch_score_fn = getattr(score_fn, "batch", None)
+        if batch_score_fn is not None:
+            if lengths is None:
+                lengths = batch.decoded_lengths
+            return batch_score_fn(batch.decoded_log_probs, lengths)
 
-    def filter_beams() -> tuple[list[Beam], list[int]]:
-        for idx in range(batch_size):
-            new_beams = []
-            for beam in current_beams[idx]:
-                if stop_fn(beam):
+        elif lengths is None:
+            scores = (score_fn(beam) for beam in batch.beams)
+        else:
+            scores = (
+                score_fn(beam, int(length))
+                for beam, length in zip(batch.beams, lengths)
+            )
+        return np.fromiter(scores, dtype=np.float64, count=len(batch))
+
+    def rank(beams: list[Beam], k: int) -> list[Beam]:
+        # best k beams by descending score, same as
+        # sorted(..., reverse=True)[:k], but only sorts the best k
+        scores = score(BeamBatch.from_beams(beams))
+        indices = np.arange(len(beams))
+        if len(beams) > k:
+            # keep ties with the k-th best score to stay stable
+            threshold = np.partition(scores, len(beams) - k)[len(beams) - k]
+            indices = indices[scores >= threshold]
+
+        order = np.argsort(-scores[indices], kind="stable")[:k]
+        return [beams[i] for i in indices[order]]
+
+    def filter_beams() -> BeamBatch:
+        batch = BeamBatch.from_beams(
+            [beam for beams in current_beams for beam in beams],
+            [idx for idx, beams in enumerate(current_beams) for _ in beams],
+        )
+
+        batch_stop_fn = getattr(stop_fn, "batch", None)
+        if batch_stop_fn is not None:
+            # check all beams at once on their last token ids and lengths
+            last_token_ids = np.fromiter(
+                (beam.last_token_id for beam in batch.beams),
+                dtype=np.int64,
+                count=len(batch),
+            )
+            done = np.asarray(batch_stop_fn(last_token_ids, batch.lengths), dtype=bool)
+        else:
+            done = np.fromiter(
+                (stop_fn(beam) for beam in batch.beams),
+                dtype=bool,
+                count=len(batch),
+            )
+        too_long = batch.lengths >= max_length
+        if max_new_tokens is not None:
+            too_long |= batch.decoded_lengths >= max_new_tokens
+
+        stopped = done | too_long
+        if stopped.any():
+            for i in np.flatnonzero(stopped):
+                beam = batch.beams[i]
+                idx = batch.indices[i]
+                if done[i]:
                     beam.stop_reason = "done"
                     finished_beams[idx].append(beam)
-                elif too_long(beam):
+                else:
                     beam.stop_reason = "length"
                     too_long_beams[idx].append(beam)
-                else:
-                    new_beams.append(beam)
 
-            current_beams[idx] = new_beams
-            if not new_beams:
-                # we are done with this batch element
-                continue
+            batch = batch.select(~stopped)
 
-            elif len(finished_beams[idx]) < beam_width:
-                continue
+        # only batch elements with enough finished beams can be done
+        check = np.array([len(f) >= beam_width for f in finished_beams], dtype=bool)
+        if not check[batch.indices].any():
+            # no active beam belongs to such a batch element
+            return batch
 
-            elif stop_condition == "max_outputs":
-                # we are done with this batch element
-                # because we have enough finished beams
-                current_beams[idx] = []
-                continue
+        elif stop_condition == "max_outputs":
+            # we are done with these batch elements
+            # because we have enough finished beams
+            return batch.select(~check[batch.indices])
 
-            worst_finished = min(
-                (score_fn(b) for b in finished_beams[idx]),
-                default=float("-inf"),
-            )
-            if stop_condition == "estimated_score":
-                # best current calculated from current length
-                # idea: is a current active beam better than the worst finished beam?
-                best_current = max(score_fn(b) for b in current_beams[idx])
-            else:
-                # best current calculated from maximum length
-                # idea: assume all remaining tokens are perfectly predicted
-                # with probability 1.0, can a current active beam be better
-                # than the worst finished beam?
-                current = next(b for b in current_beams[idx])
-                max_decoded_length = max_length - current.initial_length
-                length = min(max_decoded_length, max_new_tokens or max_decoded_length)
-                best_current = max(score_fn(b, length) for b in current_beams[idx] if b)
-
-            if worst_finished >= best_current:
-                # set current beams to None list to stop processing
-                current_beams[idx] = []
-
-        beams = []
-        indices = []
-        for idx in range(batch_size):
-            beams.extend(current_beams[idx])
-            indices.extend([idx] * len(current_beams[idx]))
-        return beams, indices
+        current = batch.select(check[batch.indices])
+        if stop_condition == "estimated_score":
+            # best current calculated from current length
+            # idea: is a current active beam better than the worst finished beam?
+            lengths = None
+        else:
+            # best current calculated from maximum length
+            # idea: assume all remaining tokens are perfectly predicted
+            # with probability 1.0, can a current active beam be better
+            # than the worst finished beam?
+            lengths = max_length - current.initial_lengths
+            if max_new_tokens is not None:
+                lengths = np.minimum(lengths, max_new_tokens)
+
+        best_current = np.full(batch_size, float("-inf"))
+        np.maximum.at(best_current, current.indices, score(current, lengths))
+
+        stop = np.zeros(batch_size, dtype=bool)
+        for idx in np.flatnonzero(check):
+            worst_finished = score(BeamBatch.from_beams(finished_beams[idx])).min()
+            stop[idx] = worst_finished >= best_current[idx]
+
+        # stop processing the beams of done batch elements
+        return batch.select(~stop[batch.indices])
 
     def get_outputs() -> list[list[Beam]]:
         outputs = []
@@ -138,106 +423,246 @@ def beam_search(
             finished = finished_beams[batch_idx]
 
             if return_unfinished and len(finished) < beam_width:
-                too_long = sorted(too_long_beams[batch_idx], key=score_fn, reverse=True)
-                finished.extend(too_long[: beam_width - len(finished)])
+                too_long = rank(too_long_beams[batch_idx], beam_width - len(finished))
+                finished.extend(too_long)
 
-            finished = sorted(finished, key=score_fn, reverse=True)
-            outputs.append(finished[:beam_width])
+            outputs.append(rank(finished, beam_width))
 
         return outputs
 
+    # pinned host buffers are reused across steps when decoding on cuda,
+    # this is safe because every step synchronizes with the device when
+    # moving the selected tokens to the cpu, so all copies out of the
+    # buffers are finished before they are overwritten
+    host_buffers: dict[str, torch.Tensor] = {}
+    pin_memory = device.type == "cuda"
+
+    def host_buffer(name: str, *shape: int) -> torch.Tensor:
+        numel = math.prod(shape)
+        if not pin_memory:
+            # the buffer might be used as is by decode_fn on cpu,
+            # so it must not be reused
+            return torch.empty(shape, dtype=torch.long)
+
+        buffer = host_buffers.get(name)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=torch.long, pin_memory=True)
+            host_buffers[name] = buffer
+
+        return buffer[:numel].view(shape)
+
+    log_softmax_topk = getattr(sample_fn, "log_softmax_topk", None)
+    if compile_selection:
+        # compile the fused selection, in reduce-overhead mode this also
+        # captures cuda graphs, removing the per step kernel launch overhead;
+        # shapes are static, so every new number of beams triggers a recompile
+        # (bounded by the dynamo cache size limit, then eager is used)
+        log_softmax_topk = torch.compile(
+            log_softmax_topk,
+            mode="reduce-overhead",
+            dynamic=False,
+        )
+
     single = beam_width == 1
-    beams, indices = filter_beams()
+    batch = filter_beams()
     cache = None
 
-    while beams:
+    while len(batch) > 0:
+        beams = batch.beams
         if cache is not None and all(beam.cache is not None for beam in beams):
-            assert cache_fn is not None, "cache_fn must be provided if cache is used"
+            assert cache_fn is not None or prefix_cache_fn is not None, (
+                "cache_fn or prefix_cache_fn must be provided if cache is used"
+            )
             cache_mask = [beam.cache for beam in beams]
-            cache_lengths = [len(beam) - 1 for beam in beams]
-            cache = cache_fn(cache, cache_mask, cache_lengths)  # type: ignore
-
-            input_ids = torch.tensor(
-                [beam.last_token_id for beam in beams],
-                device=device,
-            ).unsqueeze(-1)
-            position_ids = torch.tensor(
-                cache_lengths,
-                device=device,
-            ).unsqueeze(-1)
-            max_cache_length = max(cache_lengths) + 1
-            pad_mask = torch.tensor(
-                [
-                    [False] * (max_cache_length - len(beam)) + [True] * len(beam)
-                    for beam in beams
-                ],
-                device=device,
+            cache_lengths = (batch.lengths - 1).tolist()
+            if prefix_cache_fn is not None:
+                # let the cache function only reorder the cache after the
+                # shared prefix of the beams of a batch element
+                cache = prefix_cache_fn(
+                    cache,
+                    cache_mask,  # type: ignore
+                    cache_lengths,
+                    batch.indices.tolist(),
+                    batch.initial_lengths.tolist(),
+                )
+            else:
+                cache = cache_fn(cache, cache_mask, cache_lengths)  # type: ignore
+
+            # fill last token ids followed by position ids into one host
+            # buffer and transfer it to the device at once without blocking
+            num_beams = len(beams)
+            staging = host_buffer("inputs", 2 * num_beams)
+            values = staging.numpy()
+            values[:num_beams] = np.fromiter(
+                (beam.last_token_id for beam in beams),
+                dtype=np.int64,
+                count=num_beams,
             )
+            values[num_beams:] = batch.lengths - 1
+            inputs = staging.to(device, non_blocking=True)
+            input_ids = inputs[:num_beams].unsqueeze(-1)
+            position_ids = inputs[num_beams:].unsqueeze(-1)
+
+            max_cache_length = int(batch.lengths.max())
+            if batch.lengths.min() == max_cache_length:
+                # no padding, e.g. always for a single beam
+                pad_mask = torch.ones(
+                    (num_beams, max_cache_length),
+                    dtype=torch.bool,
+                    device=device,
+                )
+            else:
+                # beams are left padded to the max cache length, so the
+                # padding mask can be built on device from the position ids
+                cache_positions = torch.arange(max_cache_length, device=device)
+                pad_mask = cache_positions.unsqueeze(0) >= (
+                    max_cache_length - 1 - position_ids
+                )
         else:
-            input_ids = pad_sequence(
-                [torch.tensor(beam.token_ids) for beam in beams],
-                batch_first=True,
-                padding_value=pad_token_id,
-                padding_side="left",
-            ).to(device)
-            pad_mask = input_ids != pad_token_id
-            position_ids = torch.cumsum(pad_mask, -1) - 1
-            position_ids[~pad_mask] = 0
+            num_beams = len(beams)
+            max_beam_length = int(batch.lengths.max())
+            if (batch.lengths == max_beam_length).all():
+                # all beams have the same length, so fill the token ids
+                # into one host buffer without any padding
+                staging = host_buffer("inputs", num_beams, max_beam_length)
+                values = staging.numpy()
+                for i, beam in enumerate(beams):
+                    values[i] = beam.token_ids
+
+                # and transfer it to the device at once
+                input_ids = staging.to(device, non_blocking=True)
+                pad_mask = torch.ones(
+                    (num_beams, max_beam_length),
+                    dtype=torch.bool,
+                    device=device,
+                )
+                # repeat instead of expand, decode_fn might view or modify
+                # the position ids in place
+                position_ids = torch.arange(max_beam_length, device=device).repeat(
+                    num_beams, 1
+                )
+
+            else:
+                # fill left padded token ids preceded by the number of
+                # padding tokens per beam into one host buffer
+                staging = host_buffer("inputs", num_beams * (max_beam_length + 1))
+                values = staging.numpy()
+                values.fill(pad_token_id)
+                padded = values[num_beams:].reshape(num_beams, max_beam_length)
+                values[:num_beams] = max_beam_length - batch.lengths
+                for i, beam in enumerate(beams):
+                    padded[i, values[i] :] = beam.token_ids
+
+                # and transfer it to the device at once
+                inputs = staging.to(device, non_blocking=True)
+                pad_counts = inputs[:num_beams]
+                input_ids = inputs[num_beams:].view(num_beams, max_beam_length)
+                positions = torch.arange(max_beam_length, device=device)
+                pad_mask = positions.unsqueeze(0) >= pad_counts.unsqueeze(1)
+                # inputs are left padded, so position ids are just the
+                # positions shifted by the padding counts, with zeros
+                # for padding
+                position_ids = (
+                    positions.unsqueeze(0) - pad_counts.unsqueeze(1)
+                ).clamp_min_(0)
 
             if cache is not None:
-                # clear cache
+                # clear cache, the caching allocator reuses the freed memory
+                # in the next steps, so only release it to the device
+                # if explicitly requested (this synchronizes the device)
                 cache = None
-                torch.cuda.empty_cache()
+                if free_cache and device.type == "cuda":
+                    torch.cuda.empty_cache()
 
         logits, cache = decode_fn(input_ids, position_ids, pad_mask, cache)
-        log_probs = torch.log_softmax(logits, dim=-1)
-
-        # apply logit functions
-        for logit_fn in logit_fns or []:
-            logits = logit_fn(logits, beams)
 
-        selected_ids, selected_logits = sample_fn(logits, beam_width)
-        # filter out invalid ids by checking logits for -inf
-        # (prob = 0 after softmax)
-        valid_ids = torch.logical_not(torch.isneginf(selected_logits))
-
-        batch_candidates: list[list[Beam]] = [[] for _ in range(batch_size)]
+        if log_softmax_topk is not None and not logit_fns:
+            # without logit functions the selection is done on the raw
+            # logits, so it can be fused with the log softmax
+            selected_ids, selected_log_probs = log_softmax_topk(logits, beam_width)
+            # filter out invalid ids by checking log probs for -inf
+            invalid_ids = torch.isneginf(selected_log_probs)
+
+        elif not logit_fns:
+            selected_ids, selected_logits = sample_fn(logits, beam_width)
+            # without logit functions the log probs of the selected tokens
+            # follow from the raw logits, so avoid a full log softmax and
+            # only normalize them, in fp32 also for half precision logits
+            log_sum_exp = torch.logsumexp(logits.float(), dim=-1, keepdim=True)
+            selected_log_probs = (
+                torch.gather(logits, 1, selected_ids).float() - log_sum_exp
+            )
+            # filter out invalid ids by checking logits for -inf
+            # (prob = 0 after softmax)
+            invalid_ids = torch.isneginf(selected_logits)
 
-        for i, batch_idx in enumerate(indices):
-            beam = beams[i]
+        else:
+            # compute log probs in fp32, also for half precision logits,
+            # before the logit functions, which might modify the logits
+            # in place
+            log_probs = torch.log_softmax(logits, dim=-1, dtype=torch.float32)
+
+            # apply logit functions
+            for logit_fn in logit_fns:
+                logits = logit_fn(logits, beams)
+
+            selected_ids, selected_logits = sample_fn(logits, beam_width)
+            selected_log_probs = torch.gather(log_probs, 1, selected_ids)
+            # filter out invalid ids by checking logits for -inf
+            # (prob = 0 after softmax)
+            invalid_ids = torch.isneginf(selected_logits)
+
+        # mark invalid ids with -1
+        selected_ids = selected_ids.masked_fill(invalid_ids, -1)
+
+        # move selected ids and log probs to cpu at once to avoid
+        # synchronizing for every single token
+        selected_ids = selected_ids.cpu().numpy()
+        selected_log_probs = selected_log_probs.cpu().numpy()
+
+        for i, beam in enumerate(beams):
             # set cache index for beam
             beam.cache = i
 
-            for token_id in selected_ids[i, valid_ids[i]]:
-                if single:
-                    candidate = beam
-                else:
-                    # must clone here when beam_width > 1
-                    candidate = beam.clone()
-
-                token_id = int(token_id.item())
-                candidate.add(token_id, log_probs[i, token_id].item())
-                batch_candidates[batch_idx].append(candidate)
-
-        for batch_idx, candidates in enumerate(batch_candidates):
-            # reset current beams and fill with best candidates
-            current_beams[batch_idx] = []
-
-            # score and sort candidates
-            candidates = sorted(candidates, key=score_fn, reverse=True)
-
-            for candidate in candidates:
-                # update candidates
-                candidate = update_fn(candidate)
-                if candidate is None:
-                    # skip invalid candidates
-                    continue
-
-                current_beams[batch_idx].append(candidate)
-                if len(current_beams[batch_idx]) >= beam_width:
-                    break
+        if single:
+            current_beams = select_single(
+                beams,
+                batch.indices,
+                selected_ids,
+                selected_log_probs,
+                batch_size,
+                update_fn,
+            )
+        else:
+            candidates = Candidates(beams, selected_ids, selected_log_probs)
+
+            # score all candidates at once
+            batch_score_fn = getattr(score_fn, "batch", None)
+            if batch_score_fn is not None:
+                scores = batch_score_fn(
+                    (batch.decoded_log_probs[:, None] + selected_log_probs).ravel(),
+                    np.repeat(batch.decoded_lengths + 1, candidates.num_selected),
+                )
+            else:
+                scores = np.full(len(candidates.valid), float("-inf"))
+                valid_candidates = np.flatnonzero(candidates.valid)
+                candidate_batch = BeamBatch.from_beams(
+                    [candidates[c] for c in valid_candidates]
+                )
+                scores[valid_candidates] = score(candidate_batch)
+
+            ranked = RankedCandidates(
+                candidates,
+                scores,
+                np.repeat(batch.indices, candidates.num_selected),
+                batch_size,
+                beam_width,
+                # compiling the ranking kernel takes seconds on a cold cache
+                compiled=compile_ranking,
+            )
+            current_beams = ranked.select(update_fn)
 
-        beams, indices = filter_beams()
+        batch = filter_beams()
 
         if yield_intermediate:
             yield get_outputs()
@@ -0,0 +1,320 @@
+try:
+    import numpy as np
+    import torch
+except ImportError:
+    raise ImportError(
+        "numpy and torch need to be installed to use the decoding module."
+    )
+
+try:
+    import numba
+except ImportError:
+    # numba is optional, used for compiled kernels if requested
+    numba = None
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    # triton is optional, fall back to torch implementations
+    triton = None
+
+
+def _rank_candidates_numpy(
+    scores: np.ndarray,
+    valid: np.ndarray,
+    batch_indices: np.ndarray,
+    batch_size: int,
+    k: int | None,
+) -> tuple[np.ndarray, np.ndarray]:
+    if k is not None:
+        # lay out the candidates of every batch element in a row and
+        # find the k-th best score per row with a partition instead of
+        # a sort, only candidates at least as good remain to be sorted
+        counts = np.bincount(batch_indices, minlength=batch_size)
+        if counts.max(initial=0) > k:
+            starts = np.cumsum(counts) - counts
+            positions = np.arange(len(scores)) - starts[batch_indices]
+            rows = np.full((batch_size, counts.max()), float("-inf"))
+            rows[batch_indices, positions] = np.where(valid, scores, float("-inf"))
+            thresholds = -np.partition(-rows, k - 1, axis=1)[:, k - 1]
+            valid = valid & (scores >= thresholds[batch_indices])
+
+    # sort candidates by batch index and descending score at once,
+    # lexsort is stable so ties keep their original order
+    order = np.lexsort((-scores, batch_indices))
+    order = order[valid[order]]
+    bounds = np.searchsorted(batch_indices[order], np.arange(batch_size + 1))
+    return order, bounds
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _rank_candidates_numba(
+        scores: np.ndarray,
+        valid: np.ndarray,
+        batch_indices: np.ndarray,
+        batch_size: int,
+        k: int,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # candidates are grouped by batch index, so every batch element
+        # is a contiguous segment that can be sorted on its own
+        segments = np.searchsorted(batch_indices, np.arange(batch_size + 1))
+        selected = []
+        bounds = np.zeros(batch_size + 1, dtype=np.int64)
+        for b in range(batch_size):
+            start = segments[b]
+            indices = np.nonzero(valid[start : segments[b + 1]])[0] + start
+            if k > 0 and len(indices) > k:
+                # keep only candidates at least as good as the k-th best
+                threshold = -np.partition(-scores[indices], k - 1)[k - 1]
+                indices = indices[scores[indices] >= threshold]
+            selected.append(indices)
+            bounds[b + 1] = bounds[b] + len(indices)
+
+        order = np.empty(bounds[-1], dtype=np.int64)
+        for b in range(batch_size):
+            indices = selected[b]
+            # mergesort is stable so ties keep their original order
+            ranks = np.argsort(-scores[indices], kind="mergesort")
+            order[bounds[b] : bounds[b + 1]] = indices[ranks]
+
+        return order, bounds
+
+
+def rank_candidates(
+    scores: np.ndarray,
+    valid: np.ndarray,
+    batch_indices: np.ndarray,
+    batch_size: int,
+    k: int | None = None,
+    compiled: bool = False,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+
+    Rank the valid candidates of every batch element by descending score.
+    Candidates must be grouped by batch element, ties keep their order.
+    If k is given, only the k best candidates of every batch element
+    (and all candidates tied with the k-th best) are ranked, all others
+    are strictly worse. Optionally uses a kernel compiled with numba,
+    which saves a few microseconds per call for many candidates, but
+    its first call on a cold cache takes seconds to compile it.
+
+    :param scores: candidate scores, shape [num_candidates]
+    :param valid: candidate validity mask, shape [num_candidates]
+    :param batch_indices: batch element index of each candidate,
+        shape [num_candidates]
+    :param batch_size: number of batch elements
+    :param k: number of best candidates to rank per batch element,
+        all if None
+    :param compiled: use the numba kernel if numba is installed
+    :return: ranked candidate indices and bounds into them, the candidates
+        of batch element b are order[bounds[b]:bounds[b + 1]]
+    """
+    assert k is None or k > 0, "k must be None or positive"
+    if not compiled or numba is None:
+        return _rank_candidates_numpy(scores, valid, batch_indices, batch_size, k)
+
+    return _rank_candidates_numba(
+        scores.astype(np.float64, copy=False),
+        valid,
+        batch_indices.astype(np.int64, copy=False),
+        batch_size,
+        k or 0,
+    )
+
+
+def hierarchical_topk(
+    logits: torch.Tensor,
+    k: int,
+    group_size: int,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+
+    Exact top-k over the last dimension via retrieve-then-rerank:
+    split the logits into groups, take the maximum of every group,
+    select the k groups with the highest maxima and run the final
+    top-k only over the elements of those groups (and of the remainder
+    group if the vocab size is not divisible by the group size).
+    The top-k elements always lie within these groups, because every
+    group with a lower maximum is dominated by k elements from the
+    selected groups.
+    Falls back to a dense top-k when there is nothing to gain, which is
+    the case for vocabs up to about half the squared group size on cpu.
+
+    :param logits: logits, shape [batch_size, vocab_size]
+    :param k: number of elements to select
+    :param group_size: size of the groups
+    :return: indices and values of the top-k elements,
+        shape [batch_size, k] each
+    """
+    assert logits.ndim == 2, "expected logits to be 2D"
+    assert group_size > 0, "group_size must be positive"
+    n, vocab_size = logits.shape
+    k = min(k, vocab_size)
+    if vocab_size <= group_size * max(k, group_size // 2):
+        top_k = torch.topk(logits, k)
+        return top_k.indices, top_k.values
+
+    # select the k full groups with the highest maxima
+    num_full = vocab_size // group_size * group_size
+    group_max = logits[:, :num_full].reshape(n, -1, group_size).amax(-1)
+    groups = torch.topk(group_max, k).indices
+    offsets = torch.arange(group_size, device=logits.device)
+    indices = (groups.unsqueeze(-1) * group_size + offsets).view(n, -1)
+
+    # always keep the remainder group smaller than the group size as is,
+    # instead of padding it, so that only valid indices can be selected,
+    # also when fewer than k logits are finite
+    if num_full < vocab_size:
+        remainder = torch.arange(num_full, vocab_size, device=logits.device)
+        indices = torch.cat([indices, remainder.expand(n, -1)], dim=-1)
+
+    top_k = torch.topk(logits.gather(-1, indices), k)
+    return indices.gather(-1, top_k.indices), top_k.values
+
+
+if triton is not None:
+
+    @triton.jit
+    def _log_softmax_topk_kernel(
+        logits_ptr,
+        ids_ptr,
+        log_probs_ptr,
+        stride,
+        vocab_size,
+        K: tl.constexpr,
+        K_PADDED: tl.constexpr,
+        BLOCK_SIZE: tl.constexpr,
+    ):
+        row = tl.program_id(0).to(tl.int64)
+        row_ptr = logits_ptr + row * stride
+        offsets = tl.arange(0, BLOCK_SIZE)
+        slots = tl.arange(0, K_PADDED)
+
+        # online softmax statistics per lane, reduced at the end
+        lane_max = tl.full([BLOCK_SIZE], float("-inf"), tl.float32)
+        lane_sum = tl.zeros([BLOCK_SIZE], tl.float32)
+        # running top-k in registers, unsorted
+        top_values = tl.full([K_PADDED], float("-inf"), tl.float32)
+        top_ids = tl.zeros([K_PADDED], tl.int64)
+
+        for start in range(0, vocab_size, BLOCK_SIZE):
+            cols = start + offsets
+            x = tl.load(row_ptr + cols, mask=cols < vocab_size, other=float("-inf"))
+            # accumulate in fp32 regardless of the logits dtype
+            x = x.to(tl.float32)
+
+            new_max = tl.maximum(lane_max, x)
+            # avoid nan from subtracting -inf from -inf
+            safe_max = tl.where(new_max == float("-inf"), 0.0, new_max)
+            lane_sum = lane_sum * tl.exp(lane_max - safe_max) + tl.exp(x - safe_max)
+            lane_max = new_max
+
+            # merge the k best values of the block into the running top-k
+            for _ in tl.static_range(K):
+                best = tl.max(x, axis=0)
+                best_pos = tl.argmax(x, axis=0)
+                worst = tl.min(top_values, axis=0)
+                worst_slot = tl.argmin(top_values, axis=0)
+                # replace the worst slot if the best value is better
+                is_worst = slots == worst_slot
+                new_id = tl.where(best > worst, start + best_pos, top_ids)
+                top_values = tl.where(is_worst, tl.maximum(best, worst), top_values)
+                top_ids = tl.where(is_worst, new_id, top_ids)
+                x = tl.where(offsets == best_pos, float("-inf"), x)
+
+        row_max = tl.max(lane_max, axis=0)
+        safe_row_max = tl.where(row_max == float("-inf"), 0.0, row_max)
+        row_sum = tl.sum(lane_sum * tl.exp(lane_max - safe_row_max), axis=0)
+        log_sum_exp = safe_row_max + tl.log(row_sum)
+
+        # emit the top-k sorted by descending value
+        for j in tl.static_range(K):
+            best = tl.max(top_values, axis=0)
+            best_slot = tl.argmax(top_values, axis=0)
+            best_id = tl.sum(tl.where(slots == best_slot, top_ids, 0), axis=0)
+            log_prob = tl.where(best == float("-inf"), best, best - log_sum_exp)
+            tl.store(ids_ptr + row * K + j, best_id)
+            tl.store(log_probs_ptr + row * K + j, log_prob)
+            top_values = tl.where(slots == best_slot, float("-inf"), top_values)
+
+
+def _log_softmax_topk_triton(
+    logits: torch.Tensor,
+    k: int,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    n, vocab_size = logits.shape
+    if logits.stride(-1) != 1:
+        logits = logits.contiguous()
+
+    ids = torch.empty((n, k), dtype=torch.long, device=logits.device)
+    log_probs = torch.empty((n, k), dtype=torch.float32, device=logits.device)
+    _log_softmax_topk_kernel[(n,)](  # type: ignore
+        logits,
+        ids,
+        log_probs,
+        logits.stride(0),
+        vocab_size,
+        K=k,
+        K_PADDED=triton.next_power_of_2(k),  # type: ignore
+        BLOCK_SIZE=1024,
+    )
+    return ids, log_probs
+
+
+def log_softmax_topk(
+    logits: torch.Tensor,
+    k: int,
+    group_size: int | None = None,
+    fused_kernel: bool = False,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+
+    Top-k over the last dimension and the log softmax of the selected
+    elements, without materializing the full log softmax for large inputs.
+    Optionally uses a fused triton kernel reading the logits only once,
+    if triton is installed and the logits are on cuda. The kernel scans
+    every row with a single program, so it is only worth it for many
+    rows and is not enabled by default. Log probs are always computed
+    and returned in fp32, also for half precision logits.
+
+    :param logits: logits, shape [batch_size, vocab_size]
+    :param k: number of elements to select
+    :param group_size: group size for the hierarchical top-k in
+        the fallback implementation, dense top-k if None
+    :param fused_kernel: use the fused triton kernel if possible
+    :return: indices and log probs of the top-k elements,
+        shape [batch_size, k] each
+    """
+    assert logits.ndim == 2, "expected logits to be 2D"
+    k = min(k, logits.shape[-1])
+    if fused_kernel and triton is not None and logits.is_cuda and k <= 32:
+        return _log_softmax_topk_triton(logits, k)
+
+    if group_size is None:
+        top_k = torch.topk(logits, k)
+        indices, values = top_k.indices, top_k.values
+    else:
+        indices, values = hierarchical_topk(logits, k, group_size)
+
+    # logits might be in half precision, but log probs are accumulated
+    # over many steps, so normalize in fp32 (no-op for fp32 logits)
+    if logits.numel() <= 32768:
+        # for small inputs the number of kernels dominates, so a full
+        # log softmax is cheaper than computing the log sum exp
+        log_probs = torch.log_softmax(logits, -1, dtype=torch.float32)
+        log_probs = log_probs.gather(-1, indices)
+    else:
+        # the top-k values are sorted, so the first one is the row maximum
+        # and the log sum exp needs no extra reduction for it (rows without
+        # any finite logit become nan here and -inf below)
+        row_max = values[:, :1].float()
+        log_sum_exp = (
+            row_max + (logits.float() - row_max).exp_().sum(-1, keepdim=True).log_()
+        )
+        log_probs = values.float() - log_sum_exp
+
+    # keep -inf for impossible tokens, even if all tokens are impossible
+    return indices, torch.where(torch.isneginf(values), values, log_probs)
@@ -1,13 +1,49 @@
+import re
+from importlib import metadata
 from typing import Any, Callable, Protocol
 
 try:
+    import numpy as np
     import torch
     from grammar_utils.constrain import Constraint
 except ImportError:
     raise ImportError(
-        "torch and grammar_utils needs to be installed to use the decoding module."
+        "numpy, torch and grammar_utils need to be installed to use the decoding "
+        "module."
     )
 
+try:
+    from flashinfer import sampling as flashinfer_sampling
+except ImportError:
+    # flashinfer is optional, if installed it is used for
+    # sorting-free sampling and masking on cuda
+    flashinfer_sampling = None
+
+from universal_ml_utils.decoding.kernels import hierarchical_topk, log_softmax_topk
+
+
+def _flashinfer_version() -> tuple[int, ...] | None:
+    # flashinfer is distributed as flashinfer-python, older
+    # versions were also distributed as flashinfer
+    for name in ["flashinfer-python", "flashinfer"]:
+        try:
+            version = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            continue
+
+        match = re.match(r"(\d+)\.(\d+)\.(\d+)", version)
+        if match is not None:
+            return tuple(map(int, match.groups()))
+
+    return None
+
+
+# flashinfer before 0.2.3 requires pre-drawn uniform samples and does
+# not accept a torch generator, fall back to torch for such versions
+# (this matches the flashinfer extra of the package)
+if flashinfer_sampling is not None and (_flashinfer_version() or (0,)) < (0, 2, 3):
+    flashinfer_sampling = None
+
 # maps from token ids, position ids, padding mask, and optional cache
 # to distribution over next tokens and optional cache
 DecodeFn = Callable[
@@ -18,6 +54,45 @@ DecodeFn = Callable[
 # update cache according to given mask
 CacheFn = Callable[[Any, list[int], list[int]], Any]
 
+# update cache according to given mask, but with additional information
+# about the prefix of the cache that is shared between beams:
+# all beams of a batch element stem from the same initial beam, so their
+# cache up to the initial length is identical, can be stored once per
+# batch element and only the cache after it needs to be reordered
+# (decode_fn then has to handle the resulting split cache)
+PrefixCacheFn = Callable[
+    [
+        # cache
+        Any,
+        # cache index for each beam
+        list[int],
+        # cache length for each beam
+        list[int],
+        # batch element index for each beam
+        list[int],
+        # shared prefix (initial) length for each beam
+        list[int],
+    ],
+    Any,
+]
+
+
+class _Prefix:
+    # tokens shared by cloned beams, holds only token storage that
+    # no beam owns anymore but no other beam state like info or cache,
+    # so that it does not keep the state of previous steps alive
+    __slots__ = ("parent", "token_ids", "log_probs")
+
+    def __init__(
+        self,
+        parent: "_Prefix | None",
+        token_ids: list[int],
+        log_probs: list[float],
+    ) -> None:
+        self.parent = parent
+        self.token_ids = token_ids
+        self.log_probs = log_probs
+
 
 class Beam:
     def __init__(
@@ -34,32 +109,151 @@ class Beam:
         assert len(token_ids) == len(log_probs), (
             "expected token_ids and log_probs to have the same length"
         )
-        self.token_ids = token_ids
-        self.log_probs = log_probs
+        # cloned beams share their first tokens with the beam they were
+        # cloned from instead of copying them: on cloning, the tokens of
+        # a beam are handed over to a shared prefix that is never modified
+        # again, and both beams continue with their own empty lists
+        self._prefix: _Prefix | None = None
+        self._offset = 0
+        self._prefix_last_token_id: int | None = None
+        self._prefix_log_prob = 0.0
+        self._prefix_decoded_log_prob = 0.0
+        self._token_ids = token_ids
+        self._log_probs = log_probs
         if initial_length is None:
             initial_length = len(token_ids)
-        self.initial_length = initial_length
+        self._initial_length = initial_length
+        # keep running sums of the own log probs to avoid summing over
+        # all of them every time a beam is scored, they are recomputed
+        # whenever the number of own log probs changed outside of add()
+        self._num_summed = -1
+        self._own_log_prob = 0.0
+        self._own_decoded_log_prob = 0.0
         self.info: dict[str, Any] = info or {}
         self.cache = cache
         self.stop_reason = stop_reason
 
+    def _own_sums(self) -> tuple[float, float]:
+        if self._num_summed != len(self._log_probs):
+            start = max(self._initial_length - self._offset, 0)
+            self._own_log_prob = sum(self._log_probs)
+            self._own_decoded_log_prob = sum(self._log_probs[start:])
+            self._num_summed = len(self._log_probs)
+
+        return self._own_log_prob, self._own_decoded_log_prob
+
+    def _materialize(self) -> None:
+        if self._prefix is None:
+            return
+
+        # collect the tokens of all shared prefixes and own them again
+        prefixes = []
+        prefix = self._prefix
+        while prefix is not None:
+            prefixes.append(prefix)
+            prefix = prefix.parent
+
+        token_ids = []
+        log_probs = []
+        for prefix in reversed(prefixes):
+            token_ids.extend(prefix.token_ids)
+            log_probs.extend(prefix.log_probs)
+        token_ids.extend(self._token_ids)
+        log_probs.extend(self._log_probs)
+
+        log_prob, decoded_log_prob = self.log_prob, self.decoded_log_prob
+        self._prefix = None
+        self._offset = 0
+        self._prefix_last_token_id = None
+        self._prefix_log_prob = 0.0
+        self._prefix_decoded_log_prob = 0.0
+        self._token_ids = token_ids
+        self._log_probs = log_probs
+        self._num_summed = len(log_probs)
+        self._own_log_prob = log_prob
+        self._own_decoded_log_prob = decoded_log_prob
+
     def add(self, token_id: int, log_p: float) -> None:
-        self.token_ids.append(token_id)
-        self.log_probs.append(log_p)
+        self._own_sums()
+        if len(self) >= self._initial_length:
+            self._own_decoded_log_prob += log_p
+        self._own_log_prob += log_p
+        self._token_ids.append(token_id)
+        self._log_probs.append(log_p)
+        self._num_summed += 1
 
     def clone(self) -> "Beam":
-        return Beam(
-            self.token_ids.copy(),
-            self.log_probs.copy(),
-            self.initial_length,
+        # constant time, the clone shares all current tokens with this beam
+        if self._token_ids:
+            # hand over the own tokens to a new shared prefix
+            last_token_id = self._token_ids[-1]
+            log_prob, decoded_log_prob = self.log_prob, self.decoded_log_prob
+            self._prefix = _Prefix(self._prefix, self._token_ids, self._log_probs)
+            self._offset += len(self._token_ids)
+            self._prefix_last_token_id = last_token_id
+            self._prefix_log_prob = log_prob
+            self._prefix_decoded_log_prob = decoded_log_prob
+            self._token_ids = []
+            self._log_probs = []
+            self._num_summed = -1
+
+        beam = Beam(
+            [],
+            [],
+            self._initial_length,
             self.info.copy(),
             self.cache,
             self.stop_reason,
         )
+        beam._prefix = self._prefix
+        beam._offset = self._offset
+        beam._prefix_last_token_id = self._prefix_last_token_id
+        beam._prefix_log_prob = self._prefix_log_prob
+        beam._prefix_decoded_log_prob = self._prefix_decoded_log_prob
+        return beam
+
+    # the lists returned by token_ids and log_probs are owned by the beam,
+    # modifying them in place modifies the beam; the log prob sums are only
+    # recomputed when the number of log probs changes, so assign a new list
+    # to change single log probs
+    @property
+    def token_ids(self) -> list[int]:
+        self._materialize()
+        return self._token_ids
+
+    @token_ids.setter
+    def token_ids(self, token_ids: list[int]) -> None:
+        self._materialize()
+        self._token_ids = token_ids
+
+    @property
+    def log_probs(self) -> list[float]:
+        self._materialize()
+        return self._log_probs
+
+    @log_probs.setter
+    def log_probs(self, log_probs: list[float]) -> None:
+        self._materialize()
+        self._log_probs = log_probs
+        self._num_summed = -1
+
+    @property
+    def initial_length(self) -> int:
+        return self._initial_length
+
+    @initial_length.setter
+    def initial_length(self, initial_length: int) -> None:
+        self._materialize()
+        self._initial_length = initial_length
+        self._num_summed = -1
 
     @property
     def last_token_id(self) -> int:
-        return self.token_ids[-1]
+        if self._token_ids:
+            return self._token_ids[-1]
+
+        assert self._prefix_last_token_id is not None, "beam has no tokens"
+        return self._prefix_last_token_id
 
     @property
     def initial_token_ids(self) -> list[int]:
@@ -83,11 +277,11 @@ class Beam:
 
     @property
     def log_prob(self) -> float:
-        return sum(self.log_probs)
+        return self._prefix_log_prob + self._own_sums()[0]
 
     @property
     def decoded_log_prob(self) -> float:
-        return sum(self.decoded_log_probs)
+        return self._prefix_decoded_log_prob + self._own_sums()[1]
 
     @property
     def decoded_length(self) -> int:
@@ -97,7 +291,7 @@ class Beam:
         return len(self) < len(other)
 
     def __len__(self) -> int:
-        return len(self.token_ids)
+        return self._offset + len(self._token_ids)
 
     def __repr__(self) -> str:
         return f"Beam(token_ids={self.token_ids}, log_prob={self.log_prob:.4f})"
@@ -140,15 +334,49 @@ StopFn = Callable[
     bool,
 ]
 
+# optional vectorized variant of a stop function, can be attached
+# to a stop function as its batch attribute and is then used
+# by beam search to check all beams at once
+BatchStopFn = Callable[
+    [
+        # last token ids of beams, shape [num_beams]
+        np.ndarray,
+        # lengths of beams, shape [num_beams]
+        np.ndarray,
+    ],
+    # bool mask indicating which beams should be stopped, shape [num_beams]
+    np.ndarray,
+]
+
 # takes in a beam candidate and returns updated beam or None
 UpdateFn = Callable[[Beam], Beam | None]
 
+# optional vectorized variant of an update function, can be attached
+# to an update function as its batch attribute and is then used
+# by beam search to update many candidates with a single call
+BatchUpdateFn = Callable[[list[Beam]], list[Beam | None]]
+
 
 # takes in a beam (and optional length) and returns a scalar score
 class ScoreFn(Protocol):
     def __call__(self, beam: Beam, length: int | None = None) -> float: ...
 
 
+# optional vectorized variant of a score function, can be attached
+# to a score function as its batch attribute and is then used
+# by beam search to score all beams at once
+BatchScoreFn = Callable[
+    [
+        # decoded log probs of beams, shape [num_beams]
+        np.ndarray,
+        # decoded lengths of beams, shape [num_beams]
+        np.ndarray,
+    ],
+    # scores of beams, shape [num_beams]
+    np.ndarray,
+]
+
+
 def log_likelihood_score(normalize: bool = True, alpha: float = 1.0) -> ScoreFn:
     assert alpha >= 0.0, "alpha must be positive"
 
@@ -162,6 +390,15 @@ def log_likelihood_score(normalize: bool = True, alpha: float = 1.0) -> ScoreFn:
         else:
             return log_prob
 
+    def _batch_score(log_probs: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        if not normalize:
+            return log_probs
+
+        # decoded log prob is zero for zero length beams,
+        # so clipping the lengths gives the same result as above
+        return log_probs / (lengths.clip(min=1) ** alpha)
+
+    _score.batch = _batch_score  # type: ignore
     return _score
 
 
@@ -216,31 +453,90 @@ def allow_tokens(allowed_tokens: list[int]) -> LogitFn:
     return _allow_tokens
 
 
+def eos_stop(eos_token_id: int) -> StopFn:
+    def _stop(beam: Beam) -> bool:
+        return beam.last_token_id == eos_token_id
+
+    def _batch_stop(last_token_ids: np.ndarray, _lengths: np.ndarray) -> np.ndarray:
+        return last_token_ids == eos_token_id
+
+    _stop.batch = _batch_stop  # type: ignore
+    return _stop
+
+
 def identity_update() -> UpdateFn:
     def _update_fn(beam: Beam) -> Beam:
         return beam
 
+    def _batch_update_fn(beams: list[Beam]) -> list[Beam | None]:
+        return beams  # type: ignore
+
+    _update_fn.batch = _batch_update_fn  # type: ignore
     return _update_fn
 
 
-def sample() -> SampleFn:
+def _use_flashinfer(t: torch.Tensor) -> bool:
+    return flashinfer_sampling is not None and t.is_cuda
+
+
+def sample(generator: torch.Generator | None = None) -> SampleFn:
+    # samples are drawn from the given generator, or from the default
+    # generator of the device, so seeding with torch.manual_seed works
+    # with and without flashinfer (the drawn tokens differ between them)
     def _sample(logits: torch.Tensor, k: int) -> tuple[torch.Tensor, torch.Tensor]:
         assert logits.ndim == 2, "expected logits to be 2D"
         k = min(k, logits.shape[-1])
         probs = torch.softmax(logits, dim=-1)
-        indices = torch.multinomial(probs, k)
+        if k == 1 and _use_flashinfer(probs):
+            gen = generator
+            if gen is None:
+                device_idx = probs.device.index
+                if device_idx is None:
+                    device_idx = torch.cuda.current_device()
+                gen = torch.cuda.default_generators[device_idx]
+
+            indices = flashinfer_sampling.sampling_from_probs(  # type: ignore
+                probs, generator=gen
+            )
+            indices = indices.long().unsqueeze(-1)
+        else:
+            indices = torch.multinomial(probs, k, generator=generator)
         return indices, logits.gather(-1, indices)
 
     return _sample
 
 
-def greedy() -> SampleFn:
+def greedy(group_size: int | None = 128, fused_kernel: bool = False) -> SampleFn:
+    # with a group size, the top-k of logits on cpu is computed
+    # hierarchically by first retrieving the best groups of logits and then
+    # reranking within them, which is exact and much cheaper than a dense
+    # top-k for large vocabs; on other devices the many small kernels
+    # of it are not worth it, so a single dense top-k is used there;
+    # with fused_kernel, beam search selects with a fused triton kernel
+    # on cuda (see log_softmax_topk)
+    assert group_size is None or group_size > 0, "group_size must be positive"
+
+    def _group_size(logits: torch.Tensor) -> int | None:
+        return group_size if logits.device.type == "cpu" else None
+
     def _greedy(logits: torch.Tensor, k: int) -> tuple[torch.Tensor, torch.Tensor]:
         assert logits.ndim == 2, "expected logits to be 2D"
         k = min(k, logits.shape[-1])
+        logits_group_size = _group_size(logits)
+        if logits_group_size is not None:
+            return hierarchical_topk(logits, k, logits_group_size)
+
         top_k = torch.topk(logits, k)
         return top_k.indices, top_k.values
 
+    def _log_softmax_topk(
+        logits: torch.Tensor, k: int
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        return log_softmax_topk(logits, k, _group_size(logits), fused_kernel)
+
+    # selection fused with the log softmax, used by beam search
+    # instead of the greedy function if no logit functions are given
+    _greedy.log_softmax_topk = _log_softmax_topk  # type: ignore
     return _greedy
 
 
@@ -297,8 +593,22 @@ def nucleus_masking(p: float, keep_min: int = 1) -> LogitFn:
         logits: torch.Tensor,
         _: list[Beam],
     ) -> torch.Tensor:
+        if p >= 1.0:
+            # the nucleus is the whole vocab
+            return logits
+
         keep = min(keep_min, logits.shape[-1])
         probs = torch.softmax(logits, dim=-1)
+        # for p = 0 only the top tokens are kept,
+        # which the sorting path below handles exactly
+        if keep == 1 and p > 0.0 and _use_flashinfer(probs):
+            # flashinfer renormalizes to the nucleus without sorting,
+            # everything outside of it gets zero probability
+            nucleus_probs = flashinfer_sampling.top_p_renorm_probs(  # type: ignore
+                probs, p
+            )
+            return logits.masked_fill(nucleus_probs == 0, float("-inf"))
+
         sorted_probs, sorted_indices = torch.sort(probs, dim=-1, descending=True)
         cum_sum_probs = torch.cumsum(sorted_probs, dim=-1)
         nucleus = cum_sum_probs < p
@@ -307,7 +617,8 @@ def nucleus_masking(p: float, keep_min: int = 1) -> LogitFn:
         )
         sorted_logits = torch.gather(logits, -1, sorted_indices)
         sorted_logits[torch.logical_not(nucleus)] = float("-inf")
-        return sorted_logits.gather(-1, sorted_indices.argsort(-1))
+        # undo the sorting by scattering instead of sorting again
+        return torch.empty_like(logits).scatter_(-1, sorted_indices, sorted_logits)
 
     return _nuc
 
@@ -325,13 +636,15 @@ def min_p_masking(min_p: float, keep_min: int = 1) -> LogitFn:
 
         mask = probs < max_probs * min_p
 
-        sorted_indices = torch.argsort(probs, descending=True, dim=-1)
-        sorted_indices_mask = torch.gather(mask, dim=-1, index=sorted_indices)
-        sorted_indices_mask[..., :keep_min] = False
+        if keep_min > 1:
+            # always keep the most probable tokens, a top-k
+            # is enough for this, no need to sort everything
+            keep = min(keep_min, probs.shape[-1])
+            top_k_indices = torch.topk(probs, keep, dim=-1).indices
+            mask.scatter_(-1, top_k_indices, False)
 
-        indices_mask = sorted_indices_mask.scatter(
-            -1, sorted_indices, sorted_indices_mask
-        )
-        return logits.masked_fill(indices_mask, float("-inf"))
+        # with min_p <= 1 the most probable token is never masked,
+        # so keep_min = 1 needs no special handling
+        return logits.masked_fill(mask, float("-inf"))
 
     return _min_p
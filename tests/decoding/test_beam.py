@@ -0,0 +1,244 @@
+import pytest
+import torch
+
+from universal_ml_utils.decoding import (
+    beam_search,
+    eos_stop,
+    sample,
+    top_k_masking,
+)
+
+VOCAB_SIZE = 16
+EOS_TOKEN_ID = 0
+PAD_TOKEN_ID = 15
+
+
+def _run(initial, **kwargs):
+    kwargs.setdefault("stop_fn", lambda beam: beam.last_token_id == EOS_TOKEN_ID)
+    outputs = beam_search(
+        # with a beam width of one the initial lists are extended in place
+        initial=[list(token_ids) for token_ids in initial],
+        pad_token_id=PAD_TOKEN_ID,
+        max_length=8,
+        device=torch.device("cpu"),
+        return_unfinished=True,
+        **kwargs,
+    )
+    try:
+        while True:
+            next(outputs)
+    except StopIteration as e:
+        return e.value
+
+
+def _last_token_decode_fn(seed=0, use_cache=False):
+    generator = torch.Generator().manual_seed(seed)
+    weights = torch.randn(VOCAB_SIZE, VOCAB_SIZE, generator=generator) * 2.0
+    # make stopping likely before the maximum length
+    weights[:, EOS_TOKEN_ID] += 1.0
+    weights[:, PAD_TOKEN_ID] = float("-inf")
+
+    def decode_fn(token_ids, _position_ids, _pad_mask, cache):
+        # logits only depend on the last token, the cache (if used)
+        # is the number of beams of the step
+        return weights[token_ids[:, -1]], len(token_ids) if use_cache else cache
+
+    return decode_fn
+
+
+def _assert_same_outputs(expected, actual):
+    for expected_beams, actual_beams in zip(expected, actual, strict=True):
+        assert len(expected_beams) == len(actual_beams)
+        for e, a in zip(expected_beams, actual_beams, strict=True):
+            assert e.token_ids == a.token_ids
+            assert e.log_probs == a.log_probs
+            assert e.stop_reason == a.stop_reason
+
+
+def test_prefill_inputs_are_contiguous():
+    def decode_fn(token_ids, position_ids, pad_mask, cache):
+        for t in [token_ids, position_ids, pad_mask]:
+            assert t.is_contiguous()
+        # decode functions might flatten or modify their inputs
+        position_ids.view(-1).add_(0)
+        generator = torch.Generator().manual_seed(int(token_ids.sum()))
+        logits = torch.randn(len(token_ids), VOCAB_SIZE, generator=generator)
+        logits[:, PAD_TOKEN_ID] = float("-inf")
+        return logits, cache
+
+    # equal and different initial lengths
+    for initial in [[[1, 2, 3], [4, 5, 6]], [[1, 2, 3], [4]]]:
+        outputs = _run(initial, decode_fn=decode_fn, beam_width=2)
+        assert all(len(beams) > 0 for beams in outputs)
+
+
+def test_in_place_logit_fn_does_not_change_log_probs():
+    def decode_fn(token_ids, _position_ids, _pad_mask, cache):
+        generator = torch.Generator().manual_seed(int(token_ids.sum()))
+        logits = torch.randn(len(token_ids), VOCAB_SIZE, generator=generator)
+        logits[:, PAD_TOKEN_ID] = float("-inf")
+        return logits, cache
+
+    def double_in_place(logits, _beams):
+        return logits.mul_(2.0)
+
+    def double(logits, _beams):
+        return logits * 2.0
+
+    initial = [[1, 2, 3], [4]]
+    expected = _run(initial, decode_fn=decode_fn, beam_width=3, logit_fns=[double])
+    actual = _run(
+        initial, decode_fn=decode_fn, beam_width=3, logit_fns=[double_in_place]
+    )
+    for expected_beams, actual_beams in zip(expected, actual, strict=True):
+        for e, a in zip(expected_beams, actual_beams, strict=True):
+            assert e.token_ids == a.token_ids
+            assert e.log_probs == a.log_probs
+
+
+def test_compile_selection_requires_fused_selection():
+    def decode_fn(token_ids, _position_ids, _pad_mask, cache):
+        return torch.zeros(len(token_ids), VOCAB_SIZE), cache
+
+    with pytest.raises(AssertionError, match="compile_selection"):
+        _run(
+            [[1]],
+            decode_fn=decode_fn,
+            beam_width=1,
+            sample_fn=sample(),
+            compile_selection=True,
+        )
+
+    with pytest.raises(AssertionError, match="compile_selection"):
+        _run(
+            [[1]],
+            decode_fn=decode_fn,
+            beam_width=1,
+            logit_fns=[top_k_masking(2)],
+            compile_selection=True,
+        )
+
+
+@pytest.mark.parametrize("logit_fns", [None, [top_k_masking(4)]])
+def test_log_probs_of_sampled_tokens(logit_fns):
+    torch.manual_seed(0)
+    weights = torch.randn(VOCAB_SIZE, VOCAB_SIZE) * 2.0
+    weights[:, PAD_TOKEN_ID] = float("-inf")
+
+    def decode_fn(token_ids, _position_ids, _pad_mask, cache):
+        # logits only depend on the last token
+        return weights[token_ids[:, -1]], cache
+
+    outputs = _run(
+        [[1, 2, 3], [4]],
+        decode_fn=decode_fn,
+        beam_width=2,
+        sample_fn=sample(),
+        logit_fns=logit_fns,
+    )
+    expected_log_probs = torch.log_softmax(weights, dim=-1)
+    for beams in outputs:
+        for beam in beams:
+            token_ids = beam.token_ids
+            for i in range(beam.initial_length, len(beam)):
+                expected = expected_log_probs[token_ids[i - 1], token_ids[i]]
+                assert abs(beam.log_probs[i] - float(expected)) < 1e-5
+
+
+@pytest.mark.parametrize("beam_width", [1, 3])
+def test_prefix_cache_fn_inputs(beam_width):
+    initial = [[1, 2, 3], [4], [5, 6]]
+    calls = []
+
+    def prefix_cache_fn(cache, mask, lengths, batch_indices, initial_lengths):
+        calls.append(batch_indices)
+        assert len(mask) == len(lengths) == len(batch_indices) == len(initial_lengths)
+        assert all(0 <= i < cache for i in mask)
+        # beams are grouped by batch element
+        assert batch_indices == sorted(batch_indices)
+        for batch_idx, length, initial_length in zip(
+            batch_indices, lengths, initial_lengths, strict=True
+        ):
+            assert initial_length == len(initial[batch_idx])
+            assert length >= initial_length
+        return cache
+
+    decode_fn = _last_token_decode_fn(use_cache=True)
+    actual = _run(
+        initial,
+        decode_fn=decode_fn,
+        beam_width=beam_width,
+        prefix_cache_fn=prefix_cache_fn,
+    )
+    assert len(calls) > 0
+    # batch elements finish at different steps
+    assert any(set(indices) != {0, 1, 2} for indices in calls)
+
+    expected = _run(
+        initial,
+        decode_fn=decode_fn,
+        beam_width=beam_width,
+        cache_fn=lambda cache, _mask, _lengths: cache,
+    )
+    _assert_same_outputs(expected, actual)
+
+
+@pytest.mark.parametrize("beam_width", [1, 3])
+def test_eos_stop(beam_width):
+    initial = [[1, 2, 3], [4], [5, 6]]
+    decode_fn = _last_token_decode_fn()
+    expected = _run(initial, decode_fn=decode_fn, beam_width=beam_width)
+
+    stop_fn = eos_stop(EOS_TOKEN_ID)
+    for beams in expected:
+        for beam in beams:
+            assert stop_fn(beam) == (beam.stop_reason == "done")
+
+    # with and without the vectorized variant
+    actual = _run(initial, decode_fn=decode_fn, beam_width=beam_width, stop_fn=stop_fn)
+    _assert_same_outputs(expected, actual)
+    assert any(beam.stop_reason == "done" for beams in actual for beam in beams)
+
+    actual = _run(
+        initial,
+        decode_fn=decode_fn,
+        beam_width=beam_width,
+        stop_fn=lambda beam: stop_fn(beam),
+    )
+    _assert_same_outputs(expected, actual)
+
+
+@pytest.mark.parametrize("beam_width", [1, 3])
+def test_batch_update_fn(beam_width):
+    initial = [[1, 2, 3], [4], [5, 6]]
+    decode_fn = _last_token_decode_fn()
+
+    def update_fn(beam):
+        # reject some candidates
+        if beam.last_token_id in (3, 7):
+            return None
+        beam.info["updated"] = beam.info.get("updated", 0) + 1
+        return beam
+
+    batch_sizes = []
+
+    def batch_update_fn(beams):
+        batch_sizes.append(len(beams))
+        return [update_fn(beam) for beam in beams]
+
+    expected = _run(
+        initial, decode_fn=decode_fn, beam_width=beam_width, update_fn=update_fn
+    )
+
+    update_fn.batch = batch_update_fn
+    actual = _run(
+        initial, decode_fn=decode_fn, beam_width=beam_width, update_fn=update_fn
+    )
+    _assert_same_outputs(expected, actual)
+    # candidates of many beams are updated with a single call
+    assert any(size > 1 for size in batch_sizes)
+    for expected_beams, actual_beams in zip(expected, actual, strict=True):
+        for e, a in zip(expected_beams, actual_beams, strict=True):
+            assert e.info == a.info
+            decoded = a.token_ids[a.initial_length :]
+            assert all(token_id not in (3, 7) for token_id in decoded)
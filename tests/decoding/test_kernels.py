@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+import torch
+
+from universal_ml_utils.decoding import beam_search, greedy, top_k_masking
+from universal_ml_utils.decoding.kernels import (
+    hierarchical_topk,
+    log_softmax_topk,
+    numba,
+    rank_candidates,
+    triton,
+)
+
+
+def test_hierarchical_topk_matches_dense_topk():
+    torch.manual_seed(0)
+    for vocab_size in [50, 64, 257]:
+        logits = torch.randn(8, vocab_size)
+        for k in [1, 3, 5]:
+            indices, values = hierarchical_topk(logits, k, group_size=4)
+            top_k = torch.topk(logits, k)
+            assert torch.equal(values, top_k.values)
+            assert torch.equal(indices, top_k.indices)
+
+
+def test_hierarchical_topk_masked_non_divisible_vocab():
+    torch.manual_seed(0)
+    vocab_size = 50
+    for _ in range(300):
+        logits = torch.randn(4, vocab_size)
+        # (almost) everything masked, fewer than k finite logits are left
+        num_finite = int(torch.randint(0, 3, ()))
+        mask = torch.ones_like(logits, dtype=torch.bool)
+        mask[:, torch.randperm(vocab_size)[:num_finite]] = False
+        logits = logits.masked_fill(mask, float("-inf"))
+
+        indices, values = hierarchical_topk(logits, 5, group_size=4)
+        assert (indices >= 0).all() and (indices < vocab_size).all()
+        assert torch.equal(logits.gather(-1, indices), values)
+        assert torch.equal(values, torch.topk(logits, 5).values)
+
+
+def test_beam_search_greedy_groups_with_masked_logits():
+    vocab_size = 50
+    eos_token_id = 0
+
+    def decode_fn(token_ids, _position_ids, _pad_mask, cache):
+        generator = torch.Generator().manual_seed(int(token_ids.sum()))
+        logits = torch.randn(len(token_ids), vocab_size, generator=generator)
+        return logits, cache
+
+    outputs = beam_search(
+        decode_fn,
+        [[1, 2, 3]],
+        pad_token_id=vocab_size - 1,
+        max_length=8,
+        stop_fn=lambda beam: beam.last_token_id == eos_token_id,
+        device=torch.device("cpu"),
+        beam_width=5,
+        sample_fn=greedy(4),
+        logit_fns=[top_k_masking(2)],
+        return_unfinished=True,
+    )
+    try:
+        while True:
+            next(outputs)
+    except StopIteration as e:
+        beams = e.value
+
+    assert len(beams) == 1 and len(beams[0]) > 0
+    for beam in beams[0]:
+        assert all(0 <= t < vocab_size for t in beam.token_ids)
+
+
+def _check_log_softmax_topk(logits, k, **kwargs):
+    indices, log_probs = log_softmax_topk(logits, k, **kwargs)
+    expected = torch.topk(torch.log_softmax(logits.float(), dim=-1), k)
+    assert log_probs.dtype == torch.float32
+    assert torch.allclose(log_probs, expected.values, atol=1e-5)
+    # ids can only differ for tied logits
+    assert torch.equal(
+        logits.gather(-1, indices),
+        logits.gather(-1, expected.indices),
+    )
+
+
+def _log_softmax_topk_inputs(device, dtype):
+    torch.manual_seed(0)
+    for vocab_size in [50, 1000, 50257]:
+        logits = torch.randn(8, vocab_size, device=device).to(dtype)
+        # fewer than k finite logits in the first row
+        logits[0, 2:] = float("-inf")
+        yield logits
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_log_softmax_topk(dtype):
+    for logits in _log_softmax_topk_inputs("cpu", dtype):
+        for k in [1, 5]:
+            _check_log_softmax_topk(logits, k)
+            _check_log_softmax_topk(logits, k, group_size=4)
+
+
+@pytest.mark.skipif(
+    triton is None or not torch.cuda.is_available(),
+    reason="triton and cuda are required",
+)
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_log_softmax_topk_fused_kernel(dtype):
+    for logits in _log_softmax_topk_inputs("cuda", dtype):
+        for k in [1, 5, 32]:
+            _check_log_softmax_topk(logits, k, fused_kernel=True)
+
+
+def test_greedy_matches_dense_topk():
+    torch.manual_seed(0)
+    for vocab_size in [1000, 50257]:
+        logits = torch.randn(8, vocab_size)
+        indices, values = greedy()(logits, 5)
+        top_k = torch.topk(logits, 5)
+        assert torch.equal(indices, top_k.indices)
+        assert torch.equal(values, top_k.values)
+
+
+def _check_rank_candidates(compiled):
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        batch_size = int(rng.integers(1, 6))
+        batch_indices = np.repeat(
+            np.arange(batch_size), rng.integers(0, 12, batch_size)
+        )
+        # few distinct scores to test ties
+        scores = rng.integers(-4, 4, len(batch_indices)).astype(np.float64)
+        valid = rng.random(len(batch_indices)) < 0.8
+
+        for k in [None, 1, 3]:
+            order, bounds = rank_candidates(
+                scores, valid, batch_indices, batch_size, k, compiled
+            )
+            for b in range(batch_size):
+                # stable sort by descending score of the valid candidates
+                candidates = np.flatnonzero(valid & (batch_indices == b))
+                expected = candidates[np.argsort(-scores[candidates], kind="stable")]
+                ranked = order[bounds[b] : bounds[b + 1]]
+                assert np.array_equal(ranked, expected[: len(ranked)])
+                if k is None or len(ranked) < k:
+                    assert len(ranked) == len(expected)
+                elif len(ranked) < len(expected):
+                    # everything not ranked is strictly worse
+                    assert scores[expected[len(ranked)]] < scores[ranked[-1]]
+
+
+def test_rank_candidates():
+    _check_rank_candidates(compiled=False)
+
+
+@pytest.mark.skipif(numba is None, reason="numba is required")
+def test_rank_candidates_compiled():
+    _check_rank_candidates(compiled=True)
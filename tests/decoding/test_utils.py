@@ -0,0 +1,159 @@
+import gc
+import weakref
+
+import pytest
+import torch
+
+from universal_ml_utils.decoding import Beam, nucleus_masking, sample
+from universal_ml_utils.decoding.utils import flashinfer_sampling
+
+
+class _State:
+    pass
+
+
+def test_clone_shares_prefix():
+    beam = Beam([1, 2])
+    first = beam.clone()
+    beam.add(7, -1.0)
+    second = beam.clone()
+    first.add(8, -2.0)
+    second.add(9, -3.0)
+
+    assert beam.token_ids == [1, 2, 7]
+    assert first.token_ids == [1, 2, 8]
+    assert first.log_probs == [0.0, 0.0, -2.0]
+    assert second.token_ids == [1, 2, 7, 9]
+    assert second.log_probs == [0.0, 0.0, -1.0, -3.0]
+    assert second.log_prob == -4.0
+
+
+def test_clone_does_not_keep_previous_info_alive():
+    refs = []
+    beam = Beam([1, 2, 3])
+    for i in range(100):
+        beam = beam.clone()
+        state = _State()
+        refs.append(weakref.ref(state))
+        beam.info["constraint"] = state
+        beam.add(i, -0.5)
+        del state
+
+    gc.collect()
+    assert sum(ref() is not None for ref in refs) == 1
+    assert len(beam) == 103
+    assert beam.token_ids == [1, 2, 3] + list(range(100))
+
+
+def test_assigning_tokens_updates_cached_state():
+    beam = Beam([1, 2, 3], [-1.0, -2.0, -3.0], initial_length=1).clone()
+    beam.add(4, -4.0)
+
+    beam.token_ids = [5, 6]
+    beam.log_probs = [-0.5, -1.5]
+    assert len(beam) == 2
+    assert beam.last_token_id == 6
+    assert beam.log_prob == -2.0
+    assert beam.decoded_log_prob == -1.5
+
+    beam.initial_length = 0
+    assert beam.decoded_log_prob == -2.0
+    assert beam.decoded_length == 2
+
+
+def _halving_logits(num_rows: int, vocab_size: int) -> torch.Tensor:
+    # probs 1/2, 1/4, 1/8, ... in random order per row, so cumulative
+    # probs are far from the tested nucleus sizes
+    torch.manual_seed(0)
+    sorted_logits = -torch.arange(vocab_size, dtype=torch.float) * torch.log(
+        torch.tensor(2.0)
+    )
+    return torch.stack(
+        [sorted_logits[torch.randperm(vocab_size)] for _ in range(num_rows)]
+    )
+
+
+@pytest.mark.parametrize("p", [0.0, 0.3, 0.6, 0.8, 1.0])
+def test_nucleus_masking_keeps_smallest_nucleus(p):
+    logits = _halving_logits(4, 10)
+    masked = nucleus_masking(p)(logits, [])
+
+    # number of tokens needed to reach p, at least one
+    probs = torch.softmax(logits[0], dim=-1).sort(descending=True).values
+    expected = max(1, int((probs.cumsum(0) < p).sum()) + 1)
+    if p >= 1.0:
+        expected = logits.shape[-1]
+
+    kept = torch.isfinite(masked)
+    assert (kept.sum(-1) == expected).all()
+    assert torch.equal(masked[kept], logits[kept])
+    if expected < logits.shape[-1]:
+        # the kept tokens are the most probable ones
+        assert logits[kept].min() > logits[~kept].max()
+
+
+@pytest.mark.skipif(
+    flashinfer_sampling is None or not torch.cuda.is_available(),
+    reason="flashinfer and cuda are required",
+)
+@pytest.mark.parametrize("p", [0.0, 0.3, 0.6, 0.8, 1.0])
+def test_nucleus_masking_flashinfer_matches_cpu(p):
+    logits = _halving_logits(4, 10)
+    expected = nucleus_masking(p)(logits, [])
+    actual = nucleus_masking(p)(logits.cuda(), []).cpu()
+    assert torch.equal(torch.isfinite(actual), torch.isfinite(expected))
+
+
+@pytest.mark.parametrize(
+    "device",
+    [
+        "cpu",
+        pytest.param(
+            "cuda",
+            marks=pytest.mark.skipif(
+                not torch.cuda.is_available(), reason="cuda is required"
+            ),
+        ),
+    ],
+)
+def test_sample_respects_seed(device):
+    logits = torch.randn(8, 100, device=device)
+
+    samples = []
+    for _ in range(2):
+        torch.manual_seed(0)
+        samples.append(sample()(logits, 1)[0])
+    assert torch.equal(samples[0], samples[1])
+
+    generator = torch.Generator(device=device)
+    samples = []
+    for _ in range(2):
+        generator.manual_seed(0)
+        samples.append(sample(generator)(logits, 1)[0])
+    assert torch.equal(samples[0], samples[1])
+
+
+def test_modifying_tokens_in_place_updates_beam():
+    beam = Beam([1, 2, 3]).clone()
+    beam.add(0, -1.0)
+    beam.token_ids.pop()
+    beam.log_probs.pop()
+    assert len(beam) == 3
+    assert beam.last_token_id == 3
+    assert beam.log_prob == 0.0
+
+
+def test_clones_do_not_share_returned_lists():
+    parent = Beam([1, 2, 3])
+    first = parent.clone()
+    parent.token_ids[0] = 99
+    parent.add(4, -1.0)
+    second = parent.clone()
+    second.token_ids.append(5)
+    first.add(6, -2.0)
+
+    assert parent.token_ids == [99, 2, 3, 4]
+    assert first.token_ids == [1, 2, 3, 6]
+    assert first.log_prob == -2.0
+    assert second.token_ids == [99, 2, 3, 4, 5]
+    assert second.last_token_id == 5